@@ -4,19 +4,19 @@ import joblib
 import torch
 import numpy as np
 import networkx as nx
+from scipy import ndimage
 from skimage import graph
 from skimage.segmentation import felzenszwalb
 from skimage.util import img_as_float
 from skimage.segmentation import felzenszwalb
 from multiprocessing import Pool, cpu_count
 
-import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch_geometric.data import Data
+from torch_geometric.data import Batch, Data
 from torch_geometric.nn import MessagePassing
 from torch_geometric.nn import GCNConv, BatchNorm
-from torch_geometric.utils import to_networkx
+from torch_geometric.utils import scatter
 
 def calculate_segments_fz(temperature_matrix, scale, sigma, min_size):
     temperature_matrix_float = img_as_float(temperature_matrix)
@@ -27,19 +27,26 @@ def graph_initialization(temperature_matrix, segments_fz):
     # Assuming temperature_matrix is your original data matrix
     temperature_matrix_float = img_as_float(temperature_matrix)
 
-    # Create a Region Adjacency Graph using mean temperatures
-    rag = graph.rag_mean_color(temperature_matrix_float, segments_fz)
+    # Create a Region Adjacency Graph from the segmentation
+    rag = graph.RAG(segments_fz, connectivity=2)
 
-    # Iterate over regions
-    for region in np.unique(segments_fz):
-        # Find the mean temperature of the region
-        region_pixels = temperature_matrix_float[segments_fz == region]
-        mean_temperature = np.mean(region_pixels)
-        # std_temperature = np.std(region_pixels)
-        
-        # Assign the mean temperature to the corresponding node in the graph
-        rag.nodes[region]['mean temperature'] = mean_temperature
-        # rag.nodes[region]['std temperature'] = std_temperature
+    # Find the mean temperature of every region in a single labelled pass
+    regions = np.unique(segments_fz)
+    mean_temperatures = ndimage.mean(temperature_matrix_float, labels=segments_fz, index=regions)
+    # std_temperatures = ndimage.standard_deviation(temperature_matrix_float, labels=segments_fz, index=regions)
+
+    # Assign the mean temperature to the corresponding node in the graph
+    for region, mean_temperature in zip(regions, mean_temperatures):
+        rag.nodes[region]['mean temperature'] = float(mean_temperature)
+        # rag.nodes[region]['std temperature'] = float(std_temperature)
+
+    # Weight each edge by the mean temperature difference of the regions it joins, scaled by
+    # sqrt(3) as rag_mean_color did when it spread a grayscale mean over three colour channels
+    region_means = np.zeros(regions.max() + 1)
+    region_means[regions] = mean_temperatures
+    edges = np.array(list(rag.edges), dtype=np.int64).reshape(-1, 2)
+    weights = np.sqrt(3) * np.abs(region_means[edges[:, 0]] - region_means[edges[:, 1]])
+    nx.set_edge_attributes(rag, dict(zip(map(tuple, edges.tolist()), weights.tolist())), 'weight')
 
     return rag
 
@@ -47,20 +54,19 @@ def process_matrix(args):
     index, matrix, first_segments_fz = args
     return index, graph_initialization(matrix, first_segments_fz)
 
-def calculate_mean_std(train_graphs):
-    all_temperatures = [data['mean temperature'] for graph in train_graphs for _, data in graph.nodes(data=True)]
-    mean_temp = np.mean(all_temperatures)
-    std_temp = np.std(all_temperatures)
+# Get the node temperatures of a graph as an array
+def node_features(graph):
+    return np.fromiter((graph.nodes[node]['mean temperature'] for node in graph.nodes),
+                       dtype=np.float64, count=len(graph))
+
+def calculate_mean_std(train_features):
+    all_temperatures = np.concatenate(train_features)
+    mean_temp = all_temperatures.mean()
+    std_temp = all_temperatures.std()
     return mean_temp, std_temp
 
-def normalize_temperature(train_graphs, mean_temp, std_temp):
-    normalized_graphs = []
-    for graph in train_graphs:
-        normalized_graph = graph.copy()
-        for node, data in normalized_graph.nodes(data=True):
-            data['mean temperature'] = (data['mean temperature'] - mean_temp) / std_temp
-        normalized_graphs.append(normalized_graph)
-    return normalized_graphs
+def normalize_temperature(train_features, mean_temp, std_temp):
+    return [(features - mean_temp) / std_temp for features in train_features]
 
 def denormalize_temperature(train_graphs, mean_temp, std_temp):
     for graph in train_graphs:
@@ -77,6 +83,12 @@ class UnsupervisedGNNModel(MessagePassing):
     def build_conv(self, in_channels, out_channels):
         return GCNConv(in_channels, out_channels)
 
+    def set_cached(self, cached):
+        # Switch caching of the GCN normalisation on or off, dropping whatever is cached so far
+        self.conv1.cached = cached
+        self.conv1._cached_edge_index = None
+        self.conv1._cached_adj_t = None
+
     def forward(self, x, edge_index):
         x = self.conv1(x, edge_index)
         x = self.bn1(x)
@@ -85,9 +97,21 @@ class UnsupervisedGNNModel(MessagePassing):
         return x
 
 class InnerProductDecoder(torch.nn.Module):
-    def forward(self, z):
-        # Compute the inner product score
+    def __init__(self):
+        super(InnerProductDecoder, self).__init__()
+        # The encoder ends in a ReLU, so z_i . z_j is never negative; a learnable offset lets
+        # the logit drop below zero and mark a pair as a non-edge
+        self.offset = torch.nn.Parameter(torch.zeros(1))
+
+    def forward(self, z, edge_index):
+        # Compute the inner product logit of the given node pairs
+        return (z[edge_index[0]] * z[edge_index[1]]).sum(dim=-1) - self.offset
+
+    def forward_all(self, z):
+        # Compute the inner product logit of every node pair; the offset is subtracted in place
+        # so an N x N result computed in half precision stays in half precision
         adj = torch.matmul(z, z.t())
+        adj -= self.offset
         return adj
 
 class AutoEncoder(torch.nn.Module):
@@ -98,52 +122,112 @@ class AutoEncoder(torch.nn.Module):
 
     def forward(self, x, edge_index):
         encoded = self.encoder(x, edge_index)
-        decoded = self.decoder(encoded) 
+        decoded = self.decoder.forward_all(encoded)
         return decoded
 
-# Get the adjacency matrix from NetworkX graph data
-def get_adjacency_matrix(graph):
-    adj_matrix = nx.adjacency_matrix(graph)
-    return torch.tensor(adj_matrix.todense(), dtype=torch.float32)
+# Convert NetworkX graph data into a PyG Data object on the target device
+def to_pyg(graph, features, device, structure_cache=None):
+    nodes = list(graph.nodes)
+    x = torch.from_numpy(features.astype(np.float32)).view(-1, 1)
 
+    # Derive the edge list from the CSR adjacency, the GCN does not use the edge weights
+    adj_matrix = nx.to_scipy_sparse_array(graph, nodelist=nodes, weight=None, dtype=np.float32, format='csr')
 
-def weighted_binary_cross_entropy(output, target, weight=None):
-    if weight is not None:
-        assert len(weight) == 2
-        loss = weight[1] * (target * torch.log(output)) + \
-               weight[0] * ((1 - target) * torch.log(1 - output))
+    # Graphs with the same segmentation share one device copy of edge_index
+    structure_key = (adj_matrix.indptr.tobytes(), adj_matrix.indices.tobytes())
+    if structure_cache is not None and structure_key in structure_cache:
+        edge_index = structure_cache[structure_key]
     else:
-        loss = target * torch.log(output) + (1 - target) * torch.log(1 - output)
-
-    return torch.neg(torch.mean(loss))
-
-def train(model, graphs, optimizer, device, epochs):
+        crow_indices = torch.from_numpy(adj_matrix.indptr.astype(np.int64))
+        col_indices = torch.from_numpy(adj_matrix.indices.astype(np.int64))
+        row_indices = torch.repeat_interleave(torch.arange(len(nodes)), crow_indices.diff())
+        edge_index = torch.stack([row_indices, col_indices])
+
+        # Stage edge_index in pinned memory so the host-to-device copy is asynchronous
+        if device.type == 'cuda':
+            edge_index = edge_index.pin_memory()
+        edge_index = edge_index.to(device, non_blocking=True)
+
+        if structure_cache is not None:
+            structure_cache[structure_key] = edge_index
+
+    if device.type == 'cuda':
+        x = x.pin_memory()
+    return Data(x=x.to(device, non_blocking=True), edge_index=edge_index)
+
+def train(model, graphs, optimizer, device, epochs, neg_ratio=1, warmup_epochs=3):
+    # The CUDA graph is captured after the warmup epochs, which also fill the GCN cache
+    assert warmup_epochs >= 1, f'warmup_epochs must be at least 1, got {warmup_epochs}'
     model.train()
 
-    for epoch in range(epochs):
-        total_loss = 0
-
-        for graph_data in graphs:
-            x = torch.tensor([graph_data.nodes[node]['mean temperature'] for node in graph_data.nodes], dtype=torch.float32).view(-1, 1)
-            edge_index = torch.tensor([[edge[0] for edge in graph_data.edges], [edge[1] for edge in graph_data.edges]], dtype=torch.long)
-
-            data = Data(x=x, edge_index=edge_index)
-            data = data.to(device)
-
-            adjacency_matrix = get_adjacency_matrix(graph_data).to(device)
-
-            # train the model
+    # Collate all graphs into one disconnected batch so every epoch is a single step
+    batch = Batch.from_data_list(graphs)
+    pos_edge_index = batch.edge_index
+    pos_graph = batch.batch[pos_edge_index[0]]
+    graph_num_nodes = batch.ptr[1:] - batch.ptr[:-1]
+
+    # Pair each positive source with a random other node of its graph as a fixed-shape negative
+    neg_src = pos_edge_index[0].repeat(neg_ratio)
+    neg_graph = pos_graph.repeat(neg_ratio)
+    neg_ptr = batch.ptr[neg_graph]
+    neg_local = neg_src - neg_ptr
+    neg_num_nodes = graph_num_nodes[neg_graph]
+    pair_graph = torch.cat([pos_graph, neg_graph])
+    labels = torch.cat([torch.ones(pos_graph.size(0), device=device), torch.zeros(neg_graph.size(0), device=device)])
+
+    # The batched encoder sees the same shapes every epoch, so compile it once
+    encoder = torch.compile(model.encoder)
+
+    def train_step():
+        neg_shift = 1 + (torch.rand(neg_src.size(0), device=device) * (neg_num_nodes - 1)).long()
+        neg_dst = neg_ptr + (neg_local + neg_shift) % neg_num_nodes
+        neg_edge_index = torch.stack([neg_src, neg_dst])
+
+        encoded = encoder(batch.x, batch.edge_index)
+        pos_logits = model.decoder(encoded, pos_edge_index)
+        neg_logits = model.decoder(encoded, neg_edge_index)
+
+        logits = torch.cat([pos_logits, neg_logits])
+        pair_loss = F.binary_cross_entropy_with_logits(logits, labels, reduction='none')
+
+        # Average within each graph first so that every graph weighs the same
+        loss = scatter(pair_loss, pair_graph, dim=0, dim_size=batch.num_graphs, reduce='mean').mean()
+        loss.backward()
+        optimizer.step()
+        return loss
+
+    if device.type != 'cuda':
+        for epoch in range(epochs):
+            optimizer.zero_grad()
+            loss = train_step()
+            print(f'Epoch {epoch + 1}: Loss: {loss.item()}')
+        return model
+
+    # Cache the GCN normalisation of the fixed batch so the step has no host synchronisation
+    model.encoder.set_cached(True)
+
+    # Warm up on a side stream, then capture one whole training step and replay it every epoch
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for epoch in range(min(warmup_epochs, epochs)):
             optimizer.zero_grad()
-            encoded = model.encoder(data.x, data.edge_index)
-            decoded_adjacency = model.decoder(encoded) 
+            loss = train_step()
+            print(f'Epoch {epoch + 1}: Loss: {loss.item()}')
+    torch.cuda.current_stream().wait_stream(stream)
 
-            loss = ((decoded_adjacency - adjacency_matrix) ** 2).mean()
-            loss.backward()
-            optimizer.step()
+    if epochs > warmup_epochs:
+        optimizer.zero_grad(set_to_none=True)
+        step_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(step_graph):
+            static_loss = train_step()
 
-            total_loss += loss.item()
+        for epoch in range(warmup_epochs, epochs):
+            step_graph.replay()
+            print(f'Epoch {epoch + 1}: Loss: {static_loss.item()}')
 
-        print(f'Epoch {epoch + 1}: Loss: {total_loss / len(graphs)}')
+    # Turn the cache off again for the per-graph inference passes
+    model.encoder.set_cached(False)
 
     return model
 
@@ -151,24 +235,27 @@ def train(model, graphs, optimizer, device, epochs):
 def reconstruct_graphs(autoencoder, graphs, device):
     reconstructed_graphs = []
     autoencoder.eval()
-    with torch.no_grad():
-        for graph_data in graphs:
-            x = torch.tensor([graph_data.nodes[node]['mean temperature'] for node in graph_data.nodes], dtype=torch.float32).view(-1, 1)
-            edge_index = torch.tensor([[edge[0] for edge in graph_data.edges], [edge[1] for edge in graph_data.edges]], dtype=torch.long)
-            data = Data(x=x, edge_index=edge_index).to(device)
-
-            encoded = autoencoder.encoder(data.x, data.edge_index)
-            decoded_adjacency = autoencoder.decoder(encoded) 
-
-            # Convert the decoded output to a NetworkX graph object
-            reconstructed_graph = to_networkx(data, to_undirected=True)
+    # The encoder is only evaluated here, so let TorchScript fuse its GCN/BatchNorm/ReLU chain
+    encoder = torch.jit.script(autoencoder.encoder)
 
-            # Set 'mean temperature' for each node
-            for node_id, mean_temp in enumerate(x):
-                reconstructed_graph.nodes[node_id]['mean temperature'] = mean_temp.item()
-
-            decoded_adjacency = decoded_adjacency.cpu().numpy()
-            edges = np.argwhere(decoded_adjacency > 0.5)
+    with torch.no_grad():
+        for data in graphs:
+            encoded = encoder(data.x, data.edge_index)
+
+            # Only the dense N x N decoder output runs in half precision on the GPU; the encoder
+            # stays in float32 so its inputs and latents keep full precision
+            with torch.autocast(device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+                decoded_adjacency = autoencoder.decoder.forward_all(encoded)
+
+            # Convert the decoded output to a NetworkX graph object, copying the temperatures back in one go
+            temperatures = data.x.view(-1).cpu().numpy().tolist()
+            reconstructed_graph = nx.Graph()
+            reconstructed_graph.add_nodes_from((node_id, {'mean temperature': mean_temp}) for node_id, mean_temp in enumerate(temperatures))
+            reconstructed_graph.add_edges_from(data.edge_index.t().cpu().numpy())
+
+            # Threshold the logits on the device (sigmoid > 0.5) and only copy back the edge list;
+            # the graph is undirected, so keep the upper triangle without the self pairs
+            edges = (torch.triu(decoded_adjacency, diagonal=1) > 0).nonzero().cpu().numpy()
             reconstructed_graph.add_edges_from(edges)
 
             reconstructed_graphs.append(reconstructed_graph)
@@ -191,26 +278,25 @@ def view_graphs(graphs, reconstructed_graphs):
         print(f"Original: Nodes = {original_num_nodes}, Edges = {original_num_edges}")
         print(f"Reconstructed: Nodes = {reconstructed_num_nodes}, Edges = {reconstructed_num_edges}")
 
+        # Reconstructed node i is the i-th node of the original graph, so compare the arrays position-wise
+        original_temperatures = node_features(original_graph)
+        reconstructed_temperatures = node_features(reconstructed_graph)
+        temperature_differences = np.abs(original_temperatures - reconstructed_temperatures)
+
         print(f"Graph {i + 1} Node Temperatures:")
-        for node in original_graph.nodes():
-            original_temperature = original_graph.nodes[node]['mean temperature']
-            reconstructed_temperature = reconstructed_graph.nodes[node]['mean temperature']
-            temperature_difference = abs(original_temperature - reconstructed_temperature)
+        for node, original_temperature, reconstructed_temperature, temperature_difference in zip(
+                original_graph.nodes(), original_temperatures.tolist(), reconstructed_temperatures.tolist(), temperature_differences.tolist()):
             print(f"Node {node}: Original Temperature = {original_temperature}, Reconstructed Temperature = {reconstructed_temperature}, Temperature Difference = {temperature_difference}")
 
         print("\n")
 
-def generate_and_save_graph_embedding(model, graphs, device, save_path):
+def generate_and_save_graph_embedding(model, graphs, device, save_path, structure_cache=None):
     model.eval() 
     latent_representations = []
 
-    with torch.no_grad(): 
+    with torch.no_grad():
         for graph_data in graphs:
-            x = torch.tensor([graph_data.nodes[node]['mean temperature'] for node in graph_data.nodes], dtype=torch.float32).view(-1, 1)
-            edge_index = torch.tensor([[edge[0] for edge in graph_data.edges], [edge[1] for edge in graph_data.edges]], dtype=torch.long)
-
-            data = Data(x=x, edge_index=edge_index)
-            data = data.to(device)
+            data = to_pyg(graph_data, node_features(graph_data), device, structure_cache)
 
             latent_representation = model.encoder(data.x, data.edge_index)
             latent_representations.append(latent_representation.cpu().numpy())
@@ -251,8 +337,11 @@ def main():
         with open(graphs_file_path, 'wb') as file:
             joblib.dump(graphs, file)
     
-    mean_temp, std_temp = calculate_mean_std(graphs)
-    normalized_graphs = normalize_temperature(graphs, mean_temp, std_temp)
+    features = [node_features(graph) for graph in graphs]
+    mean_temp, std_temp = calculate_mean_std(features)
+    normalized_features = normalize_temperature(features, mean_temp, std_temp)
+    structure_cache = {}
+    pyg_graphs = [to_pyg(graph, feats, device, structure_cache) for graph, feats in zip(graphs, normalized_features)]
 
     input_size = 1 
     hidden_size = 1
@@ -264,21 +353,20 @@ def main():
         unsupervised_gnn_model.eval()
     else:
         unsupervised_gnn_model = AutoEncoder(input_size, hidden_size, output_size).to(device)
-        criterion = nn.MSELoss()
-        optimizer = optim.Adam(unsupervised_gnn_model.parameters(), lr=0.001)
+        optimizer = optim.Adam(unsupervised_gnn_model.parameters(), lr=0.001, capturable=device.type == 'cuda')
 
         start_time = time.time()
         print("training start...")
-        train(unsupervised_gnn_model, normalized_graphs, optimizer, device, epochs)
+        train(unsupervised_gnn_model, pyg_graphs, optimizer, device, epochs)
         torch.save(unsupervised_gnn_model.state_dict(), model_path)
 
         end_time = time.time()
         total_time = end_time - start_time
         print(f'Training done. Total time: {total_time:.2f} seconds')
 
-    generate_and_save_graph_embedding(unsupervised_gnn_model, graphs, device, '/path/to/save/latent/')
+    generate_and_save_graph_embedding(unsupervised_gnn_model, graphs, device, '/path/to/save/latent/', structure_cache)
 
-    reconstructed_graphs = reconstruct_graphs(unsupervised_gnn_model, normalized_graphs, device)
+    reconstructed_graphs = reconstruct_graphs(unsupervised_gnn_model, pyg_graphs, device)
     denormalize_temperature(reconstructed_graphs, mean_temp, std_temp)
     with open(reconstructed_graphs_file_path, 'wb') as file:
             joblib.dump(reconstructed_graphs, file)
@@ -298,9 +386,10 @@ if __name__ == '__main__':
 
     timestamp = 1
 
-    loss_type = "mse"
+    loss_type = "bce"
     model_version = 1
     os.environ["CUDA_VISIBLE_DEVICES"] = "3"
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.set_float32_matmul_precision('high')
     print(f"Using device: {device}")
     main()